@@ -1,17 +1,28 @@
 #!/usr/bin/env python3
 import os
 import time
-import json
 import csv
+import re
+import atexit
 import serial
 import queue
+import selectors
 import signal
 import socket
+import struct
 import logging
 import threading
-from datetime import datetime
+import zlib
+from logging.handlers import QueueHandler, QueueListener
+import numpy as np
+import orjson
 import paho.mqtt.client as mqtt
 
+try:
+    from numba import njit   # optional: compiles the calibration kernel
+except ImportError:
+    njit = None
+
 # =========================
 # CONFIGURATION
 # =========================
@@ -21,63 +32,137 @@ LOG_FILE = os.path.join(BASE_DIR, "sensor_errors.log")
 
 SERIAL_PORT = "/dev/ttyUSB0"
 BAUD_RATE = 115200
+MAX_FRAME = 1024             # drop partial lines longer than this
+BINARY_FRAMES = False        # True once the sketch emits packed frames
 
 MQTT_BROKER = "127.0.0.1"
 MQTT_PORT = 1883
 TOPIC = "weather/workstation"
 STATUS_TOPIC = f"weather/status/{socket.gethostname()}"
+MQTT_QOS = 0                 # fire-and-forget: no in-flight/ACK tracking
 
 READ_INTERVAL = 2            # Arduino sends every 2s
-PROCESS_INTERVAL = 2
 MAX_RETRIES = 3
 
+CSV_BUFFER_SIZE = 1 << 16    # bytes buffered before they are written out
+FLUSH_INTERVAL = 10          # seconds between CSV flushes
+SYNC_BYTES = 256 * 1024      # fsync once this much has been written…
+SYNC_INTERVAL = 30           # …or this many seconds have passed
+
+MQTT_BATCH_SIZE = 5          # samples per MQTT publish…
+MQTT_BATCH_INTERVAL = 10     # …or seconds since the last one
+HEARTBEAT_INTERVAL = 30
+HEARTBEAT_STALE = 3 * READ_INTERVAL  # report "stale" after this long without data
+
 # =========================
 # LOGGING
 # =========================
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s | %(levelname)s | %(message)s",
-    handlers=[
-        logging.FileHandler(LOG_FILE),
-        logging.StreamHandler()
-    ]
-)
+# Callers only enqueue records; the listener thread formats and writes them
+# so disk and console I/O stay off the sample path.
+log_format = logging.Formatter("%(asctime)s | %(levelname)s | %(message)s")
+log_handlers = [logging.FileHandler(LOG_FILE), logging.StreamHandler()]
+for handler in log_handlers:
+    handler.setFormatter(log_format)
+
+log_queue = queue.Queue(-1)
+logging.getLogger().setLevel(logging.INFO)
+logging.getLogger().addHandler(QueueHandler(log_queue))
+
+log_listener = QueueListener(log_queue, *log_handlers)
+log_listener.start()
+atexit.register(log_listener.stop)
 
 # =========================
 # SENSOR CALIBRATION
 # =========================
 
-def calibrate(raw):
-    """Convert raw ADC readings using stable linear approximations."""
+ADC_MAX = 1023
+
+# Field order of the Arduino frame (JSON keys or packed binary words).
+RAW_FIELDS = ("oxygen", "uv", "pressure", "solar", "temp_humidity", "co2", "air_quality")
+
+# Matches the fixed Arduino frame and captures the raw readings in RAW_FIELDS
+# order, e.g. {"oxygen":512,"uv":87,...,"air_quality":301}. Readings are
+# capped at 5 digits so int() always succeeds and fits the int32 array.
+FRAME_RE = re.compile(
+    rb"\{\s*"
+    + rb"\s*,\s*".join(rb'"%s"\s*:\s*(\d{1,5})' % f.encode() for f in RAW_FIELDS)
+    + rb"\s*\}"
+)
+
+# Packed frame: sync word 0xA5A5, the readings as little-endian uint16 in
+# RAW_FIELDS order, then the low 16 bits of zlib.crc32 over the readings.
+# 18 bytes per frame.
+FRAME_SYNC = b"\xa5\xa5"
+FRAME_STRUCT = struct.Struct("<%dH" % len(RAW_FIELDS))
+FRAME_CRC = struct.Struct("<H")
+FRAME_SIZE = len(FRAME_SYNC) + FRAME_STRUCT.size + FRAME_CRC.size
+
+# (output key, raw field, full-scale value) for each engineering channel.
+CHANNELS = (
+    ("Temperature",          "temp_humidity", 50),     # 0–50 °C approx
+    ("Humidity",             "temp_humidity", 100),    # 0–100%
+    ("CO2",                  "co2",           2000),   # ppm (approx)
+    ("Oxygen",               "oxygen",        21),     # 0–21%
+    ("UV Index",             "uv",            11),     # 0–11
+    ("Solar Radiation",      "solar",         1200),   # W/m²
+    ("Air Quality",          "air_quality",   500),    # AQI
+    ("GSR",                  "solar",         100),    # same solar sensor
+    ("Atmospheric Pressure", "pressure",      1100),   # hPa
+)
+
+KEYS = tuple(key for key, _, _ in CHANNELS)
+CHANNEL_INDEX = np.array([RAW_FIELDS.index(field) for _, field, _ in CHANNELS])
+SCALES = np.array([full for _, _, full in CHANNELS], dtype=np.float64) / ADC_MAX
+
+_last_sec = None
+_last_iso = b""
+
+def utc_timestamp():
+    """ISO-8601 UTC timestamp as bytes, only re-formatted when the second
+    ticks."""
+    global _last_sec, _last_iso
+    sec = int(time.time())
+    if sec != _last_sec:
+        _last_sec = sec
+        _last_iso = time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(sec)).encode()
+    return _last_iso
+
+def _calibrate_vectorized(raw):
+    np.clip(raw, 0, ADC_MAX, out=raw)
+    return np.round(raw[:, CHANNEL_INDEX] * SCALES, 2)
+
+def _calibrate_loop(raw):
+    # Same result as _calibrate_vectorized without its intermediate arrays:
+    # everything lands in `out`, rounded in place. Only worth running once
+    # Numba has compiled it.
+    out = np.empty((raw.shape[0], len(SCALES)))
+    for i in range(raw.shape[0]):
+        for j in range(len(SCALES)):
+            r = min(max(raw[i, CHANNEL_INDEX[j]], 0), ADC_MAX)
+            out[i, j] = r * SCALES[j]
+    np.round(out, 2, out)
+    return out
+
+calibrate_batch = _calibrate_vectorized
+if njit is not None:
+    # Compile eagerly so a Numba failure shows up here, not inside the
+    # data_processor thread on the first sample.
     try:
-        r = int(raw)
-    except:
-        return None
-    if r < 0: r = 0
-    if r > 1023: r = 1023
-    return r
-
-def convert_values(data):
-    """Convert raw ADC values to engineering units."""
-    oxy   = calibrate(data["oxygen"])
-    uv    = calibrate(data["uv"])
-    pres  = calibrate(data["pressure"])
-    solar = calibrate(data["solar"])
-    th    = calibrate(data["temp_humidity"])
-    co2   = calibrate(data["co2"])
-    aq    = calibrate(data["air_quality"])
-
-    return {
-        "Temperature": round((th / 1023) * 50, 2),            # 0–50 °C approx
-        "Humidity": round((th / 1023) * 100, 2),              # 0–100%
-        "CO2": round((co2 / 1023) * 2000, 2),                 # ppm (approx)
-        "Oxygen": round((oxy / 1023) * 21, 2),                # 0–21%
-        "UV Index": round((uv / 1023) * 11, 2),               # 0–11
-        "Solar Radiation": round((solar / 1023) * 1200, 2),   # W/m²
-        "Air Quality": round((aq / 1023) * 500, 2),           # AQI
-        "GSR": round((solar / 1023) * 100, 2),                # same solar sensor
-        "Atmospheric Pressure": round((pres / 1023) * 1100, 2) # hPa
-    }
+        calibrate_batch = njit("f8[:, :](i4[:, :])", cache=True)(_calibrate_loop)
+    except Exception as e:
+        logging.warning("Numba calibration kernel unavailable, using NumPy: %s", e)
+
+def convert_values(frames):
+    """Convert raw ADC values to engineering units using stable linear
+    approximations, clamping readings to the 10-bit ADC range.
+
+    `frames` holds one sequence of integer readings per sample, in
+    RAW_FIELDS order. The whole batch is converted in one array pass.
+    Returns (timestamp, rows) with each row's values ordered as KEYS.
+    """
+    raw = np.array(frames, dtype=np.int32).reshape(-1, len(RAW_FIELDS))
+    return utc_timestamp(), calibrate_batch(raw).tolist()
 
 # =========================
 # MQTT CLIENT
@@ -85,100 +170,243 @@ def convert_values(data):
 
 class MQTTClient:
     def __init__(self):
-        self.client = mqtt.Client()
+        self.client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
         self.connected = False
         self.client.on_connect = self._on_connect
         self.client.on_disconnect = self._on_disconnect
+        self.client.reconnect_delay_set(min_delay=1, max_delay=30)
 
-    def _on_connect(self, client, userdata, flags, rc):
-        self.connected = (rc == 0)
-        logging.info("MQTT connected" if self.connected else f"MQTT failed rc={rc}")
+    def _on_connect(self, client, userdata, flags, reason_code, properties):
+        self.connected = not reason_code.is_failure
+        if self.connected:
+            logging.info("MQTT connected")
+        else:
+            logging.info("MQTT failed rc=%s", reason_code)
 
-    def _on_disconnect(self, client, userdata, rc):
+    def _on_disconnect(self, client, userdata, flags, reason_code, properties):
         self.connected = False
-        logging.warning("MQTT disconnected")
+        logging.warning("MQTT disconnected rc=%s", reason_code)
 
     def start(self):
+        # connect_async lets the network loop retry with backoff if the
+        # broker is not up yet
         try:
-            self.client.connect(MQTT_BROKER, MQTT_PORT, 30)
+            self.client.connect_async(MQTT_BROKER, MQTT_PORT, 30)
             self.client.loop_start()
         except Exception as e:
-            logging.error(f"MQTT connection error: {e}")
+            logging.error("MQTT connection error: %s", e)
 
-    def publish(self, topic, payload):
+    def publish(self, topic, payload, retain=False):
         if self.connected:
-            self.client.publish(topic, payload)
+            self.client.publish(topic, payload, qos=MQTT_QOS, retain=retain)
         else:
             logging.warning("MQTT not connected, skipping publish")
 
 
-mqtt_client = MQTTClient()
+# Created in main (and again after fork) so a child never shares the
+# parent's broker socket or network thread.
+mqtt_client = None
 data_queue = queue.Queue()
 
+def start_mqtt():
+    global mqtt_client
+    mqtt_client = MQTTClient()
+    mqtt_client.start()
+
+def restart_mqtt_after_fork():
+    if mqtt_client is not None:
+        start_mqtt()
+
+os.register_at_fork(after_in_child=restart_mqtt_after_fork)
+
 
 # =========================
 # SERIAL READER
 # =========================
+def set_low_latency(ser):
+    """Set ASYNC_LOW_LATENCY on the port so FTDI adapters deliver bytes
+    after 1 ms instead of their default 16 ms latency timer."""
+    try:
+        ser.set_low_latency_mode(True)
+        logging.info("Low-latency mode enabled on %s", SERIAL_PORT)
+    except (AttributeError, OSError, ValueError) as e:
+        # Not Linux, or the driver does not support TIOCSSERIAL
+        logging.warning("Low-latency mode unavailable: %s", e)
+
+def read_text_frames(buf):
+    """Pop complete JSON lines off buf and return their readings."""
+    frames = []
+    while (nl := buf.find(b"\n")) >= 0:
+        line = bytes(buf[:nl]).strip()
+        del buf[:nl + 1]
+        if not line:
+            continue
+
+        m = FRAME_RE.fullmatch(line)
+        if not m:
+            logging.warning("Bad frame: %r", line)
+            continue
+
+        frames.append(tuple(map(int, m.groups())))
+
+    if len(buf) > MAX_FRAME:
+        logging.warning("Discarding %d bytes without a newline", len(buf))
+        buf.clear()
+    return frames
+
+def read_binary_frames(buf):
+    """Pop complete packed frames off buf, resyncing on FRAME_SYNC and
+    dropping frames whose CRC does not match."""
+    frames = []
+    while True:
+        start = buf.find(FRAME_SYNC)
+        if start < 0:
+            # Keep a trailing byte that may be the first half of a sync word
+            del buf[:-1]
+            return frames
+        if start:
+            logging.warning("Discarding %d bytes before frame sync", start)
+            del buf[:start]
+        if len(buf) < FRAME_SIZE:
+            return frames
+
+        body = len(FRAME_SYNC)
+        crc_at = body + FRAME_STRUCT.size
+        (crc,) = FRAME_CRC.unpack_from(buf, crc_at)
+        if zlib.crc32(buf[body:crc_at]) & 0xFFFF != crc:
+            logging.warning("Bad frame CRC: %r", bytes(buf[:FRAME_SIZE]))
+            del buf[:1]      # the sync word may have been a false match
+            continue
+
+        frames.append(FRAME_STRUCT.unpack_from(buf, body))
+        del buf[:FRAME_SIZE]
+
 def serial_reader():
     try:
         ser = serial.Serial(SERIAL_PORT, BAUD_RATE, timeout=2)
-        logging.info(f"Connected to Arduino on {SERIAL_PORT}")
+        # Wake only when the port has bytes, then drain everything available
+        fd = ser.fileno()
+        sel = selectors.DefaultSelector()
+        sel.register(fd, selectors.EVENT_READ)
+        logging.info("Connected to Arduino on %s", SERIAL_PORT)
     except Exception as e:
-        logging.error(f"Serial error: {e}")
+        logging.error("Serial error: %s", e)
         return
 
+    set_low_latency(ser)
+    read_frames = read_binary_frames if BINARY_FRAMES else read_text_frames
+    buf = bytearray()
+
     while True:
         try:
-            line = ser.readline().decode("utf-8").strip()
-            if not line:
+            if not sel.select(timeout=1.0):
                 continue
 
-            if not line.startswith("{") or not line.endswith("}"):
-                logging.warning(f"Bad JSON: {line}")
-                continue
+            chunk = os.read(fd, 4096)
+            if not chunk:
+                raise OSError("serial port returned EOF")
+            buf += chunk
 
-            data = json.loads(line)
-            data_queue.put(data)
+            for frame in read_frames(buf):
+                data_queue.put(frame)
 
+        except BlockingIOError:
+            continue         # spurious readiness on the O_NONBLOCK port fd
         except Exception as e:
-            logging.error(f"Serial read error: {e}")
-
-        time.sleep(0.1)
+            logging.error("Serial read error: %s", e)
+            time.sleep(0.1)  # avoid spinning if the port has gone away
 
 
 # =========================
 # DATA PROCESSOR
 # =========================
+# One JSON object per sample, keyed by KEYS, rendered straight from the
+# value row so no per-sample dict is built for the MQTT payload.
+JSON_ROW_FMT = b"{" + b",".join(b'"%b":%%.2f' % k.encode() for k in KEYS) + b"}"
+
+def process_batch(frames, pending):
+    """Calibrate a batch of frames, append it to the CSV in one write and
+    queue it for the next MQTT publish."""
+    global last_processed
+    ts, values = convert_values(frames)
+
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        for v in values:
+            logging.debug("CALIBRATED → %r", dict(zip(KEYS, v)))
+
+    write_csv([(ts, *v) for v in values])
+    pending.extend(values)
+    last_processed = time.monotonic()
+
 def data_processor():
-    ensure_csv()
+    open_csv()
+    pending = []     # value rows awaiting the next MQTT publish
+    last_publish = time.monotonic()
 
     while True:
-        if data_queue.empty():
-            time.sleep(0.05)
-            continue
-
-        raw = data_queue.get()
-        calibrated = convert_values(raw)
+        try:
+            frames = [data_queue.get(timeout=1.0)]
+        except queue.Empty:
+            frames = []
+
+        # Take everything else already queued so it is handled in one pass
+        while frames:
+            try:
+                frames.append(data_queue.get_nowait())
+            except queue.Empty:
+                break
+
+        if frames:
+            process_batch(frames, pending)
+        else:
+            write_csv([])    # keep the flush/sync timers running while idle
 
-        logging.info("CALIBRATED → " + str(calibrated))
+        # Publish to MQTT as one retained JSON array
+        now = time.monotonic()
+        if pending and (len(pending) >= MQTT_BATCH_SIZE
+                        or now - last_publish >= MQTT_BATCH_INTERVAL):
+            payload = b"[" + b",".join(JSON_ROW_FMT % (*v,) for v in pending) + b"]"
+            mqtt_client.publish(TOPIC, payload, retain=True)
+            pending.clear()
+            last_publish = now
 
-        # Write to CSV
-        write_csv(calibrated)
 
-        # Publish to MQTT
-        mqtt_client.publish(TOPIC, json.dumps(calibrated))
+# =========================
+# HEARTBEAT
+# =========================
+heartbeat = {"ts": 0.0, "status": "ok"}
+last_processed = 0.0     # monotonic time of the last processed batch
 
-        # Heartbeat
-        hb = json.dumps({"ts": time.time(), "status": "ok"})
-        mqtt_client.publish(STATUS_TOPIC + "/hb", hb)
+def schedule_heartbeat():
+    timer = threading.Timer(HEARTBEAT_INTERVAL, publish_heartbeat)
+    timer.daemon = True
+    timer.start()
 
-        time.sleep(PROCESS_INTERVAL)
+def publish_heartbeat():
+    # "ok" only while samples are actually flowing through data_processor
+    fresh = time.monotonic() - last_processed <= HEARTBEAT_STALE
+    heartbeat["status"] = "ok" if fresh else "stale"
+    heartbeat["ts"] = time.time()
+    mqtt_client.publish(STATUS_TOPIC + "/hb", orjson.dumps(heartbeat))
+    schedule_heartbeat()
 
 
 # =========================
 # CSV HANDLING
 # =========================
 
+# One timestamp and len(KEYS) values per row, matching csv.writer's line ending
+ROW_FMT = b"%b" + b",%.2f" * len(KEYS) + b"\r\n"
+
+csv_fd = None
+csv_buffer = bytearray()
+csv_lock = threading.Lock()
+last_flush = 0.0
+last_sync = 0.0
+bytes_since_sync = 0
+sync_fd = None
+sync_event = threading.Event()
+
 def ensure_csv():
     if not os.path.exists(CSV_FILE):
         with open(CSV_FILE, "w", newline="") as f:
@@ -189,21 +417,66 @@ def ensure_csv():
                 "Atmospheric Pressure"
             ])
 
-def write_csv(data):
-    with open(CSV_FILE, "a", newline="") as f:
-        writer = csv.writer(f)
-        writer.writerow([
-            datetime.utcnow().isoformat(),
-            data["Temperature"],
-            data["Humidity"],
-            data["CO2"],
-            data["Oxygen"],
-            data["UV Index"],
-            data["Solar Radiation"],
-            data["Air Quality"],
-            data["GSR"],
-            data["Atmospheric Pressure"]
-        ])
+def open_csv():
+    """Open the CSV once and keep the descriptor for the lifetime of the process."""
+    global csv_fd, last_flush, last_sync, sync_fd
+    ensure_csv()
+    csv_fd = os.open(CSV_FILE, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    last_flush = last_sync = time.monotonic()
+    # Private descriptor for the syncer so it never races close_csv()
+    sync_fd = os.dup(csv_fd)
+    threading.Thread(target=csv_syncer, daemon=True).start()
+    atexit.register(close_csv)
+
+def write_csv(rows):
+    """Append a batch of (timestamp, *values) rows; write them out once
+    CSV_BUFFER_SIZE or FLUSH_INTERVAL is reached and fsync once
+    SYNC_BYTES or SYNC_INTERVAL is reached."""
+    global last_flush, last_sync, bytes_since_sync
+    with csv_lock:
+        if csv_fd is None:
+            return
+        size = len(csv_buffer)
+        for row in rows:
+            csv_buffer.extend(ROW_FMT % row)
+        bytes_since_sync += len(csv_buffer) - size
+
+        now = time.monotonic()
+        if bytes_since_sync >= SYNC_BYTES or (
+                bytes_since_sync and now - last_sync >= SYNC_INTERVAL):
+            flush_csv()
+            bytes_since_sync = 0
+            sync_event.set()
+            last_flush = last_sync = now
+        elif len(csv_buffer) >= CSV_BUFFER_SIZE or now - last_flush >= FLUSH_INTERVAL:
+            flush_csv()
+            last_flush = now
+
+def flush_csv():
+    """Write the buffered rows to the file. Caller must hold csv_lock."""
+    written = 0
+    while written < len(csv_buffer):
+        written += os.write(csv_fd, csv_buffer[written:])
+    csv_buffer.clear()
+
+def csv_syncer():
+    """fsync the CSV in the background so data_processor never waits on disk."""
+    while True:
+        sync_event.wait()
+        sync_event.clear()
+        try:
+            os.fsync(sync_fd)
+        except OSError as e:
+            logging.error("CSV sync error: %s", e)
+
+def close_csv():
+    global csv_fd
+    with csv_lock:
+        if csv_fd is not None:
+            flush_csv()
+            os.fsync(csv_fd)
+            os.close(csv_fd)
+            csv_fd = None
 
 
 # =========================
@@ -211,7 +484,10 @@ def write_csv(data):
 # =========================
 def shutdown(sig, frame):
     logging.info("Shutting down backend…")
-    mqtt_client.client.loop_stop()
+    if mqtt_client is not None:
+        mqtt_client.client.loop_stop()
+    close_csv()          # os._exit skips atexit handlers
+    log_listener.stop()
     os._exit(0)
 
 signal.signal(signal.SIGINT, shutdown)
@@ -224,7 +500,8 @@ signal.signal(signal.SIGTERM, shutdown)
 if __name__ == "__main__":
     logging.info("Weather backend starting…")
 
-    mqtt_client.start()
+    start_mqtt()
+    schedule_heartbeat()
 
     threading.Thread(target=serial_reader, daemon=True).start()
     threading.Thread(target=data_processor, daemon=True).start()